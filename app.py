@@ -1,15 +1,19 @@
+import hmac
 import json
+import signal
 import logging
 import asyncio
 import traceback
+import functools
+import contextlib
 from http import HTTPStatus
 
-from fastapi.responses import HTMLResponse
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Request
 
 from llm import DashScopeLLMClient
-from manager import WebSocketManager
-from manager import Role, CompletionMessage, SessionStatus
+from manager import WebSocketManager, HistoryStore
+from manager import Role, CompletionMessage, SessionStatus, CompletionPolicy
 from formater import LLMMessageFormater, RespMessageFormater
 
 
@@ -18,16 +22,79 @@ logger = logging.getLogger(__name__)
 
 BASE_URL = 'https://dashscope.aliyuncs.com/compatible-mode/v1'
 API_KEY = 'xxx'
-
-
-app = FastAPI()
-
-
-websocket_manager = WebSocketManager()
+# 同一session有回答在运行时，新消息的处理方式：supersede取消旧回答，queue排队等待
+COMPLETION_POLICY = CompletionPolicy.SUPERSEDE
+# queue模式下每个session最多排队的消息数
+MAX_QUEUED_COMPLETIONS = 3
+# 历史消息存储目录，排空和退出时写入，超过HISTORY_RETENTION秒未恢复的删除
+HISTORY_DIR = 'history'
+HISTORY_RETENTION = 24 * 3600
+# 排空时等待正在运行的回答结束的最长时间（秒）
+DRAIN_TIMEOUT = 60
+# 收到该信号时开始排空，Windows下没有SIGUSR1，只能通过管理接口触发
+DRAIN_SIGNAL = getattr(signal, 'SIGUSR1', None)
+# 排空完成后是否退出进程，不退出时恢复接受新连接
+DRAIN_EXIT = True
+# 管理接口的令牌，通过请求头X-Admin-Token传入，为空时不启用管理接口
+ADMIN_TOKEN = ''
+# 应用层心跳间隔（秒），超过HEARTBEAT_TIMEOUT秒没有收到客户端消息的连接被回收，
+# 不依赖uvicorn的ws_ping，用uvicorn app:app启动时同样生效
+HEARTBEAT_INTERVAL = 20
+HEARTBEAT_TIMEOUT = 60
+
+
+drain_task: asyncio.Task | None = None
+
+
+async def drain():
+    await websocket_manager.drain(DRAIN_TIMEOUT)
+    if DRAIN_EXIT:
+        # 交给uvicorn正常退出
+        signal.raise_signal(signal.SIGINT)
+    else:
+        websocket_manager.resume()
+
+
+def start_drain():
+    global drain_task
+    if not drain_task or drain_task.done():
+        drain_task = asyncio.create_task(drain())
+    return drain_task
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app: FastAPI):
+    loop = asyncio.get_running_loop()
+    if DRAIN_SIGNAL is not None:
+        try:
+            loop.add_signal_handler(DRAIN_SIGNAL, start_drain)
+        except NotImplementedError:
+            logger.warning("当前平台不支持信号处理，只能通过管理接口触发排空")
+
+    await asyncio.to_thread(websocket_manager.history_store.prune, HISTORY_RETENTION)
+
+    heartbeat_task = asyncio.create_task(
+        websocket_manager.heartbeat(HEARTBEAT_INTERVAL, HEARTBEAT_TIMEOUT))
+
+    yield
+
+    heartbeat_task.cancel()
+    # 退出时仍在内存中的历史消息写入存储
+    await websocket_manager.flush_history()
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+websocket_manager = WebSocketManager(
+    completion_policy=COMPLETION_POLICY,
+    max_queued=MAX_QUEUED_COMPLETIONS,
+    history_store=HistoryStore(HISTORY_DIR)
+)
 llm_client = DashScopeLLMClient(base_url=BASE_URL, api_key=API_KEY)
 
 
-async def completion(websocket, session, client_args):
+async def completion(websocket, client_id, session, client_args):
     llm_msg_formater = LLMMessageFormater()
     resp_msg_formater = RespMessageFormater()
 
@@ -36,23 +103,23 @@ async def completion(websocket, session, client_args):
     user_message = client_args.get("message", "")
     stream = client_args.get("stream", True)
 
-    # 保存为历史消息
-    message = CompletionMessage(
-        name="user",
-        role=Role.USER,
-        content=user_message
-    )
-    websocket_manager.add_history(session_id, message)
-
-    # 格式化llm消息
-    llm_messages = await llm_msg_formater.format(session)
-    completion_args = {
-        "model": client_args.get("model", llm_client.default_model),
-        "messages": llm_messages,
-        "stream": stream
-    }
-
     try:
+        # 保存为历史消息
+        message = CompletionMessage(
+            name="user",
+            role=Role.USER,
+            content=user_message
+        )
+        websocket_manager.add_history(client_id, session_id, message)
+
+        # 格式化llm消息
+        llm_messages = await llm_msg_formater.format(session)
+        completion_args = {
+            "model": client_args.get("model", llm_client.default_model),
+            "messages": llm_messages,
+            "stream": stream
+        }
+
         full_content = ""
         if stream:
             async for resp in await llm_client.chat_stream(**completion_args):
@@ -75,7 +142,7 @@ async def completion(websocket, session, client_args):
                         )
                     )
 
-                    await websocket_manager.send_json_message({
+                    await websocket_manager.send_session_message({
                         **resp_message,
                         "status": SessionStatus.RUNNING
                     }, websocket)
@@ -90,7 +157,7 @@ async def completion(websocket, session, client_args):
                             content=resp.message
                         )
                     )
-                    await websocket_manager.send_json_message({
+                    await websocket_manager.send_session_message({
                         **resp_message,
                         "status": SessionStatus.ERROR
                     }, websocket)
@@ -106,7 +173,7 @@ async def completion(websocket, session, client_args):
                         content=full_content
                     )
                 )
-                await websocket_manager.send_json_message({
+                await websocket_manager.send_session_message({
                     **resp_message,
                     "status": SessionStatus.RUNNING
                 }, websocket)
@@ -119,7 +186,7 @@ async def completion(websocket, session, client_args):
                     content=None
                 )
             )
-            await websocket_manager.send_json_message({
+            await websocket_manager.send_session_message({
                 **resp_message,
                 "status": SessionStatus.COMPLETED
             }, websocket)
@@ -129,7 +196,7 @@ async def completion(websocket, session, client_args):
                 role=Role.ASSISTANT,
                 content=full_content
             )
-            websocket_manager.add_history(session_id, message)
+            websocket_manager.add_history(client_id, session_id, message)
     except asyncio.CancelledError:
         raise
     except json.JSONDecodeError:
@@ -141,7 +208,7 @@ async def completion(websocket, session, client_args):
             )
         )
 
-        await websocket_manager.send_json_message({
+        await websocket_manager.send_session_message({
             **resp_message,
             "status": SessionStatus.ERROR
         }, websocket)
@@ -155,7 +222,7 @@ async def completion(websocket, session, client_args):
                 content=f"处理消息时出错: {str(e)}"
             )
         )
-        await websocket_manager.send_json_message({
+        await websocket_manager.send_session_message({
             **resp_message,
             "status": SessionStatus.ERROR
         }, websocket)
@@ -164,6 +231,13 @@ async def completion(websocket, session, client_args):
 
 @app.websocket("/ws/chat/{client_id}")
 async def websocket_chat(websocket: WebSocket, client_id: str):
+    # 排空中不再接受新连接，1013: try again later
+    # 需要先accept，否则客户端只会收到403，看不到关闭码
+    if not websocket_manager.is_serving:
+        await websocket.accept()
+        await websocket.close(code=1013)
+        return
+
     try:
         # WebSoket连接，创建session_manager，一个client_id对应一个session_manager
         await websocket_manager.connect(websocket, client_id)
@@ -181,7 +255,23 @@ async def websocket_chat(websocket: WebSocket, client_id: str):
         while True:
             # 客户端消息
             data = await websocket.receive_text()
+            websocket_manager.touch(websocket)
             args = json.loads(data)
+
+            # 心跳回复
+            if args.get("type") == "pong":
+                continue
+
+            # 排空中只处理取消，不再开始新的回答
+            if not websocket_manager.is_serving and \
+                    args.get("message", "").strip() != 'cancel':
+                await websocket_manager.send_session_message({
+                    "session_id": args.get('session_id'),
+                    "message": "服务即将重启，请重新连接",
+                    "status": websocket_manager.status
+                }, websocket)
+                continue
+
             # 通过session manager创建session
             session_id = args.get('session_id')
             session = await session_manager.create_session(session_id)
@@ -201,20 +291,51 @@ async def websocket_chat(websocket: WebSocket, client_id: str):
                             content="会话已取消"
                         )
                     )
-                    await websocket_manager.send_json_message({
+                    await websocket_manager.send_session_message({
                         **resp_message,
                         "status": SessionStatus.CANCELLED
                     }, websocket)
-            else:
-                # 如果session状态是cancelled，更新为created
-                if session.is_cancelled:
-                    session.status = SessionStatus.CREATED
-                    session.cancel_event.clear()
-                    session.is_cancelled = False
+                continue
 
-            # 创建task，并在后台运行
-            task = asyncio.create_task(completion(websocket, session, args))
-            session.task = task
+            # 如果session状态是cancelled，更新为created
+            if session.is_cancelled:
+                session.status = SessionStatus.CREATED
+                session.cancel_event.clear()
+                session.is_cancelled = False
+
+            # 创建task，并在后台运行，同一session同时只有一个task
+            try:
+                superseded = await session_manager.submit_task(
+                    session_id,
+                    functools.partial(completion, websocket, client_id, session, args),
+                    owner=websocket
+                )
+            except ValueError as e:
+                resp_message = await resp_msg_formater.format(
+                    session_id,
+                    CompletionMessage(
+                        role=Role.SYSTEM,
+                        content=str(e)
+                    )
+                )
+                await websocket_manager.send_session_message({
+                    **resp_message,
+                    "status": SessionStatus.ERROR
+                }, websocket)
+                continue
+
+            if superseded:
+                resp_message = await resp_msg_formater.format(
+                    session_id,
+                    CompletionMessage(
+                        role=Role.ASSISTANT,
+                        content="回答已被新消息取代"
+                    )
+                )
+                await websocket_manager.send_session_message({
+                    **resp_message,
+                    "status": SessionStatus.CANCELLED
+                }, websocket)
 
     except asyncio.CancelledError:
         await websocket_manager.disconnect(websocket)
@@ -226,6 +347,58 @@ async def websocket_chat(websocket: WebSocket, client_id: str):
         await websocket_manager.disconnect(websocket)
 
 
+@app.get("/healthz")
+async def healthz():
+    """存活检查
+    """
+    return {"status": "ok"}
+
+
+@app.get("/readyz")
+async def readyz():
+    """就绪检查，排空中返回503，负载均衡据此摘除流量
+    """
+    status_code = HTTPStatus.OK if websocket_manager.is_serving \
+        else HTTPStatus.SERVICE_UNAVAILABLE
+    return JSONResponse(
+        {
+            "status": websocket_manager.status,
+            "connections": len(websocket_manager.connections)
+        },
+        status_code=status_code
+    )
+
+
+@app.get("/metrics")
+async def metrics():
+    """连接指标
+    """
+    return {
+        "connections": len(websocket_manager.connections),
+        "sessions": sum(
+            len(session_manager.sessions)
+            for session_manager in websocket_manager.session_manager.values()
+        ),
+        "reaping_connections": len(websocket_manager.reaping),
+        "reaped_connections": websocket_manager.reaped_connections
+    }
+
+
+@app.post("/admin/drain")
+async def admin_drain(request: Request):
+    """开始排空，需要在请求头X-Admin-Token中传入ADMIN_TOKEN
+    """
+    token = request.headers.get("X-Admin-Token", "")
+    if not ADMIN_TOKEN or not hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+        return JSONResponse({"message": "forbidden"}, status_code=HTTPStatus.FORBIDDEN)
+
+    start_drain()
+    return JSONResponse(
+        {"status": websocket_manager.status, "timeout": DRAIN_TIMEOUT},
+        status_code=HTTPStatus.ACCEPTED
+    )
+
+
 @app.get("/")
 async def get():
     """聊天页面
@@ -327,7 +500,14 @@ async def get():
             }
             
             // 建立WebSocket连接
-            const ws = new WebSocket(`ws://127.0.0.1:8011/ws/chat/${clientId}`);
+            let ws = null;
+            function connect() {
+                ws = new WebSocket(`ws://127.0.0.1:8011/ws/chat/${clientId}`);
+                ws.onopen = onOpen;
+                ws.onmessage = onMessage;
+                ws.onclose = onClose;
+                ws.onerror = onError;
+            }
             const messages = document.getElementById('messages');
             const messageInput = document.getElementById('messageInput');
             const streamChecked = document.getElementById('streamChecked');
@@ -335,8 +515,14 @@ async def get():
             let currentStreamDiv = null;
             let currentStreamContent = ''; // 用于存储流式输出的完整内容
     
-            ws.onmessage = function(event) {
+            function onMessage(event) {
                 const data = JSON.parse(event.data);
+
+                // 回复服务端心跳
+                if (data.status === 'ping') {
+                    ws.send(JSON.stringify({type: 'pong'}));
+                    return;
+                }
     
                 if (data.status === 'running') {
                     if (streamChecked.checked === true) {
@@ -360,6 +546,8 @@ async def get():
                     currentStreamContent = ''; // 清空累积内容
                 } else if (data.status === 'error') {
                     addMessage('错误: ' + data.message, 'system');
+                } else if (data.status === 'draining') {
+                    addMessage(data.message, 'system');
                 }
     
                 messages.scrollTop = messages.scrollHeight;
@@ -373,15 +561,39 @@ async def get():
                     document.getElementById('sessionIdDisplay').textContent = session_id;
                     document.getElementById('sessionInfo').style.display = 'flex';
                 }
-            };
+            }
     
-            ws.onclose = function() {
-                addMessage('连接已断开', 'system');
-            };
+            let reconnectAttempts = 0;
+
+            function onOpen() {
+                if (reconnectAttempts > 0) {
+                    addMessage('已重新连接', 'system');
+                }
+                reconnectAttempts = 0;
+            }
+
+            function onClose(event) {
+                if (reconnectAttempts === 0) {
+                    addMessage('连接已断开', 'system');
+                }
+                // 服务重启（1012）或暂不可用（1013）后重新连接，重连失败时继续重试
+                if (event.code === 1012 || event.code === 1013 || reconnectAttempts > 0) {
+                    // 指数退避，随机抖动避免客户端同时重连
+                    const backoff = Math.min(30000, 1000 * Math.pow(2, reconnectAttempts));
+                    const delay = backoff / 2 + Math.random() * backoff / 2;
+                    reconnectAttempts += 1;
+                    setTimeout(function() {
+                        addMessage('正在重新连接...', 'system');
+                        connect();
+                    }, delay);
+                }
+            }
     
-            ws.onerror = function(error) {
+            function onError(error) {
                 addMessage('连接错误: ' + error, 'system');
-            };
+            }
+
+            connect();
     
             document.getElementById('messageForm').onsubmit = function(e) {
                 e.preventDefault();
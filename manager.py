@@ -1,10 +1,15 @@
+import os
+import re
+import json
 import time
 import asyncio
 import datetime
+import tempfile
 import logging
 import traceback
 from enum import Enum
-from typing import List, Dict
+from collections import deque
+from typing import List, Dict, Callable, Awaitable
 
 import shortuuid
 from fastapi import WebSocket
@@ -21,6 +26,17 @@ class SessionStatus(str, Enum):
     COMPLETED = 'completed'
 
 
+class CompletionPolicy(str, Enum):
+    SUPERSEDE = 'supersede'  # 新消息取消正在运行的回答
+    QUEUE = 'queue'  # 新消息排队，等待正在运行的回答结束
+
+
+class ServerStatus(str, Enum):
+    SERVING = 'serving'
+    DRAINING = 'draining'  # 不再接受新会话，等待正在运行的回答结束
+    STOPPED = 'stopped'
+
+
 class Role(str, Enum):
     SYSTEM = 'system'
     ASSISTANT = 'assistant'
@@ -43,6 +59,26 @@ class CompletionMessage(BaseMessage):
         self.content = content
         self.timestamp = time.time()
 
+    def to_dict(self) -> Dict:
+        return {
+            "id": self.id,
+            "name": self.name,
+            "role": self.role,
+            "content": self.content,
+            "timestamp": self.timestamp,
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "CompletionMessage":
+        message = cls(
+            role=Role(data["role"]),
+            content=data.get("content"),
+            name=data.get("name")
+        )
+        message.id = data.get("id", message.id)
+        message.timestamp = data.get("timestamp", message.timestamp)
+        return message
+
 
 class Session:
     """session，每个session中有多条task（message）
@@ -54,6 +90,8 @@ class Session:
                  status: SessionStatus = SessionStatus.CREATED):
         self.id = session_id or shortuuid.uuid()
         self.task: asyncio.Task = task
+        # 正在运行和排队中的task，及提交task的连接
+        self.tasks: Dict[asyncio.Task, WebSocket | None] = {}
         self.cancel_event = asyncio.Event()
         self.messages: List[CompletionMessage] = []
         self.status: SessionStatus = status
@@ -62,10 +100,105 @@ class Session:
         self.end_time = None
 
 
+class HistoryStore:
+    """历史消息存储，排空和退出时写入，按客户端分目录，每个session保存为一个json文件
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def _path(self, client_id: str, session_id: str) -> str | None:
+        # client_id、session_id来自客户端，只允许字母数字，避免路径穿越
+        for name in (client_id, session_id):
+            if not name or not re.fullmatch(r'[A-Za-z0-9_-]+', name):
+                return None
+        return os.path.join(self.directory, client_id, f"{session_id}.json")
+
+    def save(self, client_id: str, session: Session):
+        """保存session的历史消息
+        """
+        path = self._path(client_id, session.id)
+        if not path or not session.messages:
+            return
+
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump([message.to_dict() for message in session.messages],
+                          f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+
+    def load(self, client_id: str, session_id: str) -> List[CompletionMessage]:
+        """读取session的历史消息，文件在下次保存时覆盖，或超过保留时间后删除
+        """
+        path = self._path(client_id, session_id)
+        if not path or not os.path.exists(path):
+            return []
+
+        try:
+            with open(path, encoding='utf-8') as f:
+                return [CompletionMessage.from_dict(data) for data in json.load(f)]
+        except Exception as e:
+            logger.error(traceback.format_exc())
+            return []
+
+    def prune(self, max_age: float):
+        """删除超过max_age秒未恢复的历史消息
+        """
+        if not os.path.isdir(self.directory):
+            return
+
+        expire_time = time.time() - max_age
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    if os.path.getmtime(path) < expire_time:
+                        os.remove(path)
+                except OSError:
+                    logger.error(traceback.format_exc())
+
+
+async def _wait_or_cancel(coros: List[Awaitable], timeout: float):
+    """并发等待，超时后取消未完成的task
+    """
+    if not coros:
+        return
+
+    tasks = [asyncio.ensure_future(coro) for coro in coros]
+    _, pending = await asyncio.wait(tasks, timeout=timeout)
+    for task in pending:
+        task.cancel()
+    if pending:
+        await asyncio.wait(pending)
+
+
+async def _run_after(prev_task: asyncio.Task,
+                     task_factory: Callable[[], Awaitable]):
+    """等待上一个task结束后再运行
+    """
+    await asyncio.wait([prev_task])
+    return await task_factory()
+
+
 class SessionManager:
 
-    def __init__(self):
+    def __init__(self,
+                 completion_policy: CompletionPolicy = CompletionPolicy.SUPERSEDE,
+                 history_store: HistoryStore | None = None,
+                 max_queued: int = 3,
+                 client_id: str | None = None):
+        self.client_id = client_id
         self.sessions: Dict[str, Session] = {}
+        self.completion_policy = completion_policy
+        self.history_store = history_store
+        # QUEUE模式下每个session最多排队的task数
+        self.max_queued = max_queued
 
     async def create_session(self, session_id):
         """创建会话
@@ -75,6 +208,10 @@ class SessionManager:
             self.sessions[session.id] = session
         elif not self.sessions.get(session_id):
             session = Session(session_id)
+            # 服务重启后，从存储中恢复历史消息
+            if self.history_store:
+                session.messages = await asyncio.to_thread(
+                    self.history_store.load, self.client_id, session_id)
             self.sessions[session.id] = session
         else:
             session = self.sessions.get(session_id)
@@ -87,6 +224,63 @@ class SessionManager:
         """
         return self.sessions.get(session_id)
 
+    async def submit_task(self,
+                          session_id: str,
+                          task_factory: Callable[[], Awaitable],
+                          owner: WebSocket | None = None) -> bool:
+        """提交task，每个session同时只有一个task在运行
+
+        返回是否取消了正在运行的task
+        """
+        session = self.sessions.get(session_id)
+        if not session:
+            raise ValueError(f"会话 {session_id} 不存在，提交失败")
+
+        prev_task = session.task
+        if not prev_task or prev_task.done():
+            self._start_task(session, task_factory(), owner)
+            return False
+
+        if self.completion_policy == CompletionPolicy.QUEUE:
+            # 除正在运行的task外，排队的task数不超过max_queued
+            if len(session.tasks) > self.max_queued:
+                raise ValueError(f"会话 {session_id} 排队的消息过多，请稍后再试")
+
+            self._start_task(session, _run_after(prev_task, task_factory), owner)
+            logger.info(f"会话 {session_id} 已有回答在运行，新消息排队")
+            return False
+
+        # 取消正在运行的task，等待其退出后再启动新的task
+        prev_task.cancel()
+        await asyncio.wait([prev_task])
+        self._start_task(session, task_factory(), owner)
+        logger.info(f"会话 {session_id} 正在运行的回答已被新消息取代")
+        return True
+
+    @staticmethod
+    def _start_task(session: Session,
+                    coro: Awaitable,
+                    owner: WebSocket | None = None) -> asyncio.Task:
+        task = asyncio.create_task(coro)
+        session.task = task
+        session.tasks[task] = owner
+        task.add_done_callback(lambda t: session.tasks.pop(t, None))
+        return task
+
+    async def cancel_tasks(self, owner: WebSocket | None = None):
+        """取消正在运行的task，并等待其退出，指定owner时只取消该连接提交的task
+        """
+        tasks = [
+            task for session in self.sessions.values()
+            for task, task_owner in list(session.tasks.items())
+            if owner is None or task_owner is owner
+        ]
+        for task in tasks:
+            task.cancel()
+
+        if tasks:
+            await asyncio.wait(tasks)
+
     async def cancel_session(self, session_id=None):
         """取消会话
         """
@@ -106,6 +300,9 @@ class SessionManager:
             for session in session_list:
                 if session.status in enable_cancel_status:
                     session.cancel_event.set()
+                    # 连同排队中的task一起取消
+                    for task in list(session.tasks):
+                        task.cancel()
                     session.is_cancelled = True
                     session.status = SessionStatus.CANCELLED
                     session.end_time = datetime.datetime.now().isoformat()
@@ -114,11 +311,153 @@ class SessionManager:
         return False
 
 
+class FrameScheduler:
+    """连接的消息帧调度器，一个连接上的多个session按轮转方式发送，
+    避免单个长回答占满连接
+    """
+
+    def __init__(self, websocket: WebSocket, max_pending: int = 32):
+        self.websocket = websocket
+        self.max_pending = max_pending
+        self.queues: Dict[str, asyncio.Queue] = {}
+        self.order: deque = deque()
+        # 每个session等待入队的task数，有等待时不移除队列
+        self.waiting: Dict[str, int] = {}
+        self.ready = asyncio.Event()
+        self.task: asyncio.Task | None = None
+        self.is_closed = False
+
+    def start(self):
+        if not self.task:
+            self.task = asyncio.create_task(self._run())
+
+    def _get_queue(self, session_id: str) -> asyncio.Queue:
+        queue = self.queues.get(session_id)
+        if queue is None:
+            queue = asyncio.Queue(self.max_pending)
+            self.queues[session_id] = queue
+            self.order.append(session_id)
+        return queue
+
+    async def put(self, session_id: str, message: dict):
+        """消息帧入队，session的待发送帧超过max_pending时等待
+        """
+        if self.is_closed:
+            raise ConnectionError("连接已关闭，消息发送失败")
+
+        queue = self._get_queue(session_id)
+        self.waiting[session_id] = self.waiting.get(session_id, 0) + 1
+        try:
+            await queue.put(message)
+        finally:
+            self.waiting[session_id] -= 1
+            if not self.waiting[session_id]:
+                self.waiting.pop(session_id)
+        self.ready.set()
+
+    def offer(self, session_id: str, message: dict) -> bool:
+        """消息帧入队，不等待，队列已满时丢弃
+        """
+        if self.is_closed:
+            return False
+
+        queue = self._get_queue(session_id)
+        try:
+            queue.put_nowait(message)
+        except asyncio.QueueFull:
+            return False
+
+        self.ready.set()
+        return True
+
+    async def _run(self):
+        try:
+            while True:
+                await self.ready.wait()
+                self.ready.clear()
+
+                # 每轮每个session最多发送一帧
+                sent = True
+                while sent:
+                    sent = False
+                    for _ in range(len(self.order)):
+                        if not self.order:
+                            break
+
+                        session_id = self.order[0]
+                        self.order.rotate(-1)
+                        queue = self.queues[session_id]
+                        if queue.empty():
+                            continue
+
+                        message = queue.get_nowait()
+                        try:
+                            await self.websocket.send_json(message)
+                        finally:
+                            queue.task_done()
+                        sent = True
+                        self._remove_idle(session_id)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(traceback.format_exc())
+        finally:
+            self.is_closed = True
+            self._discard_pending()
+
+    def _remove_idle(self, session_id: str):
+        """session的帧都已发送且没有等待入队的task时，移除其队列
+        """
+        queue = self.queues.get(session_id)
+        if queue is None or not queue.empty() or self.waiting.get(session_id):
+            return
+
+        self.queues.pop(session_id)
+        self.order.remove(session_id)
+
+    def _discard_pending(self):
+        """丢弃未发送的帧，唤醒等待入队的task
+        """
+        for queue in self.queues.values():
+            while not queue.empty():
+                queue.get_nowait()
+                queue.task_done()
+
+    async def join(self):
+        """等待已入队的帧发送完成
+        """
+        await asyncio.gather(*[queue.join() for queue in list(self.queues.values())])
+
+    def close(self):
+        """关闭调度器
+        """
+        self.is_closed = True
+        if self.task and not self.task.done():
+            self.task.cancel()
+        self._discard_pending()
+
+
 class WebSocketManager:
-    def __init__(self, client_id=None):
+    def __init__(self,
+                 client_id=None,
+                 completion_policy: CompletionPolicy = CompletionPolicy.SUPERSEDE,
+                 history_store: HistoryStore | None = None,
+                 max_queued: int = 3):
         self.client_id = client_id or shortuuid.uuid()
+        self.completion_policy = completion_policy
+        self.max_queued = max_queued
+        self.history_store = history_store
+        self.status = ServerStatus.SERVING
         self.connections: List[WebSocket] = []
         self.session_manager: Dict[str, SessionManager] = {}
+        self.schedulers: Dict[WebSocket, FrameScheduler] = {}
+        # 连接对应的客户端、处理task和最后一次收到消息的时间
+        self.clients: Dict[WebSocket, str] = {}
+        self.handlers: Dict[WebSocket, asyncio.Task] = {}
+        self.heartbeats: Dict[WebSocket, float] = {}
+        # 正在回收的连接（gauge）和累计回收的连接数（counter）
+        self.reaping: Dict[WebSocket, asyncio.Task] = {}
+        self.reaped_connections = 0
 
     async def connect(self, websocket: WebSocket, client_id: str):
         try:
@@ -129,22 +468,110 @@ class WebSocketManager:
 
         self.connections.append(websocket)
 
-        if not self.client_id or self.client_id not in self.session_manager:
-            self.client_id = client_id
-            self.session_manager[client_id] = SessionManager()
+        scheduler = FrameScheduler(websocket)
+        scheduler.start()
+        self.schedulers[websocket] = scheduler
+
+        self.clients[websocket] = client_id
+        self.handlers[websocket] = asyncio.current_task()
+        self.heartbeats[websocket] = time.monotonic()
+
+        if client_id not in self.session_manager:
+            self.session_manager[client_id] = SessionManager(
+                completion_policy=self.completion_policy,
+                history_store=self.history_store,
+                max_queued=self.max_queued,
+                client_id=client_id
+            )
 
-        logger.info(f"客户端 {self.client_id} 已连接")
+        logger.info(f"客户端 {client_id} 已连接")
 
     async def disconnect(self, websocket: WebSocket):
+        if websocket not in self.connections:
+            return
+
         # 移除WebSocket连接
         self.connections.remove(websocket)
+        self.handlers.pop(websocket, None)
+        self.heartbeats.pop(websocket, None)
+        client_id = self.clients.pop(websocket, None)
+
+        scheduler = self.schedulers.pop(websocket, None)
+        if scheduler:
+            scheduler.close()
+
+        # 同一客户端还有其他连接时保留sessions，只取消该连接提交的task
+        session_manager = self.session_manager.get(client_id)
+        if client_id in self.clients.values():
+            if session_manager:
+                await session_manager.cancel_tasks(websocket)
+            logger.info(f"客户端 {client_id} 连接已断开")
+            return
 
-        # 清空sessions
-        session_manager = self.session_manager.pop(self.client_id)
+        # 取消正在运行的task，清空sessions
+        self.session_manager.pop(client_id, None)
         if session_manager:
+            await session_manager.cancel_tasks()
             session_manager.sessions = []
 
-        logger.info(f"客户端 {self.client_id} 连接已断开")
+        logger.info(f"客户端 {client_id} 连接已断开")
+
+    def touch(self, websocket: WebSocket):
+        """记录收到客户端消息的时间
+        """
+        if websocket in self.heartbeats:
+            self.heartbeats[websocket] = time.monotonic()
+
+    async def reap(self, websocket: WebSocket):
+        """回收失联的连接，取消连接的task并释放状态
+        """
+        client_id = self.clients.get(websocket)
+        logger.warning(f"客户端 {client_id} 心跳超时，回收连接")
+        self.reaped_connections += 1
+
+        # 取消连接的处理task，由其调用disconnect释放状态
+        handler = self.handlers.get(websocket)
+        if handler and not handler.done() and handler is not asyncio.current_task():
+            handler.cancel()
+            await asyncio.wait([handler], timeout=5)
+
+        await self.disconnect(websocket)
+        await _wait_or_cancel([self._close(websocket)], timeout=5)
+
+    def _start_reap(self, websocket: WebSocket):
+        async def _reap():
+            try:
+                await self.reap(websocket)
+            except Exception as e:
+                logger.error(traceback.format_exc())
+
+        task = asyncio.create_task(_reap())
+        self.reaping[websocket] = task
+        task.add_done_callback(lambda t: self.reaping.pop(websocket, None))
+
+    async def heartbeat(self, interval: float, timeout: float):
+        """定时向客户端发送ping，超过timeout秒没有收到客户端消息的连接在后台回收，
+        回收不阻塞其他连接的ping
+        """
+        while True:
+            await asyncio.sleep(interval)
+
+            for websocket in list(self.connections):
+                if websocket in self.reaping:
+                    continue
+
+                now = time.monotonic()
+                last_seen = self.heartbeats.get(websocket, now)
+                if now - last_seen > timeout:
+                    self._start_reap(websocket)
+                    continue
+
+                scheduler = self.schedulers.get(websocket)
+                if scheduler:
+                    scheduler.offer(None, {
+                        "status": "ping",
+                        "timestamp": time.time()
+                    })
 
     @staticmethod
     async def send_text_message(message: str, websocket: WebSocket):
@@ -162,34 +589,130 @@ class WebSocketManager:
             logger.error(traceback.format_exc())
             raise
 
-    def check_session(self, session_id):
-        if self.client_id not in self.session_manager:
-            logger.warning(f"客户端 {self.client_id} 连接不存在")
-            raise ValueError(f"客户端 {self.client_id} 连接不存在")
+    @property
+    def is_serving(self) -> bool:
+        return self.status == ServerStatus.SERVING
+
+    async def _save_history(self, session_manager: SessionManager):
+        if not self.history_store or not session_manager.sessions:
+            return
+
+        for session in list(session_manager.sessions.values()):
+            try:
+                await asyncio.to_thread(
+                    self.history_store.save, session_manager.client_id, session)
+            except Exception as e:
+                logger.error(traceback.format_exc())
+
+    async def flush_history(self):
+        """所有session的历史消息写入存储
+        """
+        for session_manager in list(self.session_manager.values()):
+            await self._save_history(session_manager)
+
+    async def drain(self, timeout: float):
+        """排空连接：不再接受新会话，通知客户端重新连接，
+        等待正在运行的回答结束（最多timeout秒），历史消息写入存储后关闭连接
+        """
+        if not self.is_serving:
+            return
+
+        self.status = ServerStatus.DRAINING
+        logger.info(f"开始排空连接，等待正在运行的回答结束，最多 {timeout} 秒")
+
+        for websocket in list(self.connections):
+            try:
+                await self.send_session_message({
+                    "message": "服务即将重启，请重新连接",
+                    "timestamp": time.time(),
+                    "status": ServerStatus.DRAINING
+                }, websocket)
+            except Exception as e:
+                logger.error(traceback.format_exc())
+
+        tasks = [
+            task
+            for session_manager in list(self.session_manager.values())
+            for session in list(session_manager.sessions.values())
+            for task in list(session.tasks)
+        ]
+        if tasks:
+            _, pending = await asyncio.wait(tasks, timeout=timeout)
+            if pending:
+                logger.warning(f"排空超时，取消 {len(pending)} 个正在运行的回答")
+                for task in pending:
+                    task.cancel()
+                await asyncio.wait(pending)
+
+        await self.flush_history()
+
+        # 等待已入队的帧发送完成
+        await _wait_or_cancel(
+            [scheduler.join() for scheduler in list(self.schedulers.values())],
+            timeout=5
+        )
+
+        # 1012: service restart，客户端收到后重新连接，失联的连接不等待
+        await _wait_or_cancel(
+            [self._close(websocket, 1012) for websocket in list(self.connections)],
+            timeout=5
+        )
+
+        self.status = ServerStatus.STOPPED
+        logger.info("连接排空完成")
+
+    @staticmethod
+    async def _close(websocket: WebSocket, code: int = 1000):
+        try:
+            await websocket.close(code=code)
+        except Exception as e:
+            # 连接可能已经关闭
+            logger.debug(f"连接关闭失败: {e}")
+
+    def resume(self):
+        """排空完成后不退出进程时，恢复接受新连接
+        """
+        if self.status == ServerStatus.STOPPED:
+            self.status = ServerStatus.SERVING
+            logger.info("恢复接受新连接")
+
+    async def send_session_message(self, message: dict, websocket: WebSocket):
+        """发送session消息，同一连接上的多个session公平轮转发送
+        """
+        scheduler = self.schedulers.get(websocket)
+        if not scheduler:
+            return await self.send_json_message(message, websocket)
+
+        await scheduler.put(message.get("session_id"), message)
+
+    def check_session(self, client_id: str, session_id: str):
+        if client_id not in self.session_manager:
+            logger.warning(f"客户端 {client_id} 连接不存在")
+            raise ValueError(f"客户端 {client_id} 连接不存在")
 
-        session_manager = self.session_manager[self.client_id]
+        session_manager = self.session_manager[client_id]
         if session_id not in session_manager.sessions:
-            logger.warning(f"客户端 {self.client_id} 会话 {session_id} 不存在")
-            raise ValueError(f"客户端 {self.client_id} 会话 {session_id} 不存在")
+            logger.warning(f"客户端 {client_id} 会话 {session_id} 不存在")
+            raise ValueError(f"客户端 {client_id} 会话 {session_id} 不存在")
 
         return session_manager.sessions[session_id]
 
-    def add_history(self, session_id: str, message: CompletionMessage):
+    def add_history(self, client_id: str, session_id: str, message: CompletionMessage):
         """添加历史消息
         """
         try:
-            session = self.check_session(session_id)
+            session = self.check_session(client_id, session_id)
             session.messages.append(message)
             return
         except Exception as e:
             logger.error(traceback.format_exc())
             raise
 
-    def get_history(self, session_id: str) -> List[CompletionMessage]:
+    def get_history(self, client_id: str, session_id: str) -> List[CompletionMessage]:
         """获取历史消息
         """
         try:
-            session = self.check_session(session_id)
+            session = self.check_session(client_id, session_id)
             return session.messages
         except Exception as e:
             logger.error(traceback.format_exc())